@@ -1,552 +1,765 @@
-"""
-This is the main entry point for the lunch roulette script.
-"""
-
-import argparse
-from collections import defaultdict
-import logging
-import random
-import re
-import subprocess
-import sys
-import openpyxl
-from contextlib import closing
-from datetime import datetime
-
-logger = logging.getLogger(__name__)
-
-
-def main():
-    parser = argparse.ArgumentParser(
-        description="Read and write to the supplied XLSX file to match people"
-        " for lunch roulette"
-    )
-    parser.add_argument(
-        "--xlsx",
-        required=True,
-        help="The path to the XLSX file that stores lunch roulette information",
-    )
-    parser.add_argument(
-        "--out",
-        help="If supplied, the input XLSX file will not be overwritten for"
-        " changes, and this file will be written instead.  Note that the output"
-        " will have all formulas replaced with their data.",
-    )
-    parser.add_argument(
-        "--lunch-date",
-        type=lambda x: datetime.strptime(x, r"%Y%m%d").date(),
-        help="The date of the lunch we're rouletting for, in YYYYMMDD format",
-    )
-    action_group = parser.add_mutually_exclusive_group(required=True)
-    action_group.add_argument(
-        "--roulette",
-        action="store_true",
-        help="Match people for the lunch date and add a column to the XLSX file"
-        " named like match_YYYYMMDD with the results, for review.",
-    )
-    action_group.add_argument(
-        "--send-matches",
-        action="store_true",
-        help="If specified, emails will be sent for the given lunch date.  This"
-        " assumes that the XLSX file has a column named like match_YYYYMMDD for"
-        " the given lunch date.  The intention is for the XLSX file to be"
-        " filled in and reviewed before sending emails.",
-    )
-    action_group.add_argument(
-        "--send-announcement",
-        action="store_true",
-        help="Send an announcement email to all users that are subscribed to"
-        " lunch roulette.",
-    )
-    parser.add_argument(
-        "--dry-run",
-        action="store_true",
-        help="If specified, we'll print the commands that we would execute"
-        " without actually executing them.  So emails will not be sent, for"
-        " example.",
-    )
-    parser.add_argument(
-        "--template",
-        help="Path to the Outlook template to use with"
-        " lunch-roulette-email.ps1.  This argument is required if --send-emails"
-        " or --dry-run-send-emails is specified.",
-    )
-    parser.add_argument(
-        "--debug",
-        action="store_true",
-        help="If specified, the log level will be DEBUG instead of INFO",
-    )
-
-    args = parser.parse_args()
-    logging.basicConfig(
-        stream=sys.stdout, level=logging.DEBUG if args.debug else logging.INFO
-    )
-
-    try:
-        with closing(
-            # Use data_only so that we use the values as of the last time Excel
-            # opened the spreadsheet, instead of the raw formulas.  We can't
-            # compute the values of formulas in this script; that's too
-            # complicated.
-            openpyxl.load_workbook(args.xlsx, data_only=True)
-        ) as workbook:
-            logger.debug(f"Opened XLSX file {args.xlsx}")
-            if args.roulette:
-                assert (
-                    not args.dry_run
-                ), "--dry-run is not supported for --roulette"
-                assert (
-                    args.lunch_date
-                ), "--lunch-date argument is required for --roulette"
-                out_filename = args.xlsx
-                if args.out:
-                    out_filename = args.out
-                do_roulette(workbook, args.lunch_date, out_filename)
-            elif args.send_matches:
-                assert (
-                    args.lunch_date
-                ), "--lunch-date argument is required for sending matches"
-                assert (
-                    args.template
-                ), "--template argument is required when sending emails"
-                send_matches(
-                    workbook,
-                    args.lunch_date,
-                    args.template,
-                    dry_run=args.dry_run,
-                )
-            elif args.send_announcement:
-                assert (
-                    args.template
-                ), "--template argument is required when sending emails"
-                send_announcement(
-                    workbook,
-                    args.template,
-                    dry_run=args.dry_run,
-                )
-    except PermissionError:
-        logger.error(
-            "Permission error!  Make sure that the XLSX file is not already"
-            " open in Excel."
-        )
-        raise
-
-
-def do_roulette(workbook, lunch_date, out_filename):
-    """
-    Do the lunch roulette.
-    """
-    # Assume that the active worksheet is the only interesting one.  This
-    # script wasn't written to account for multiple worksheets.
-    worksheet = workbook.active
-
-    columns = parse_worksheet_columns(worksheet)
-    logger.debug(f"Parsed columns from the workbook: {columns}")
-
-    users = load_users(
-        worksheet,
-        columns,
-        ["email", "frequency", "cluster", "new_to_cluster", "all_matches"],
-    )
-    logger.debug(f"Parsed {len(users)} users: {users}")
-
-    # We don't really support frequency at the moment.  We only filter out those
-    # users that have a frequency of 0.  We also allow 2 as a placeholder for
-    # those students that may be willing to meet more frequently.
-    users = {k: v for k, v in users.items() if v["frequency"]}
-    assert all([v["frequency"] in [None, 0, 1, 2] for v in users.values()])
-
-    matches = match_users(users)
-    logger.debug(f"Matches: {matches}")
-
-    update_worksheet_with_matches(
-        worksheet, users, columns, matches, lunch_date
-    )
-    workbook.save(out_filename)
-    logger.info(
-        f"Saved lunch roulette for {lunch_date.strftime('%Y-%m-%d')} to"
-        f" {out_filename}"
-    )
-
-
-def send_matches(workbook, lunch_date, template_path, dry_run=False):
-    """
-    Send the lunch roulette match emails.
-    """
-    # Assume that the active worksheet is the only interesting one.  This
-    # script wasn't written to account for multiple worksheets.
-    worksheet = workbook.active
-
-    columns = parse_worksheet_columns(worksheet)
-    logger.debug(f"Parsed columns from the workbook: {columns}")
-
-    match_column_header = make_match_column_header(lunch_date)
-    if match_column_header not in columns:
-        raise Exception(
-            f"XLSX file doesn't contain {match_column_header} column"
-        )
-
-    users = load_users(
-        worksheet,
-        columns,
-        [
-            "email",
-            "friendly_name",
-            "full_name",
-            "gender",
-            "frequency",
-            "all_matches",
-            match_column_header,
-        ],
-    )
-    logger.debug(f"Parsed {len(users)} users: {users}")
-
-    send_match_emails(users, lunch_date, template_path, dry_run=dry_run)
-
-
-def send_announcement(workbook, template_path, dry_run=False):
-    """
-    Send an announcement to everybody, not only those with matches on a
-    particular day.
-    """
-    # Assume that the active worksheet is the only interesting one.  This
-    # script wasn't written to account for multiple worksheets.
-    worksheet = workbook.active
-
-    columns = parse_worksheet_columns(worksheet)
-    logger.debug(f"Parsed columns from the workbook: {columns}")
-
-    users = load_users(
-        worksheet,
-        columns,
-        [
-            "email",
-            "friendly_name",
-            "frequency",
-        ],
-    )
-    logger.debug(f"Parsed {len(users)} users: {users}")
-
-    send_announcement_emails(users, template_path, dry_run=dry_run)
-
-
-def parse_worksheet_columns(worksheet):
-    """
-    Parse the provided workbook to identify the columns that we care about.
-    """
-    columns = {
-        "email": None,
-        "frequency": None,
-        "friendly_name": None,
-        "full_name": None,
-        "gender": None,
-        "cluster": None,
-        "year": None,
-        "new_to_cluster": None,
-        "all_matches": [],  # This is a special storing all of the match columns
-        "first_empty": None,  # This is a placeholder
-    }
-    required_columns = [
-        "email",
-        "friendly_name",
-        "full_name",
-        "gender",
-        "cluster",
-        "year",
-    ]
-
-    # Iterator through the first row, assuming that it contains all of the
-    # column headers.
-    column_number = 1  # The current column's number
-    value = worksheet.cell(row=1, column=column_number).value
-    while value:
-        logger.debug(f"Column #{column_number} header: {value}")
-
-        # Save all of the match columns.
-        if is_match_column_header(value):
-            # Match columns can be duplicated, to signify that some people got more than one match.
-            if value not in columns:
-                columns[value] = []
-            columns[value].append(column_number)
-            columns["all_matches"].append(column_number)
-        elif value in columns and value not in ["first_empty"]:
-            columns[value] = column_number
-
-        column_number += 1
-        value = worksheet.cell(row=1, column=column_number).value
-
-    assert columns["first_empty"] is None
-    columns["first_empty"] = column_number
-
-    for required_column in required_columns:
-        if columns[required_column] is None:
-            raise Exception(
-                f"Worksheet missing required column {required_column}"
-            )
-
-    # Remove all None columns from the result.  This simplifies some of the
-    # usage elsewhere.
-    column_list = list(columns.keys())
-    for column in column_list:
-        if columns[column] is None:
-            del columns[column]
-
-    return columns
-
-
-def load_users(worksheet, columns, load_columns):
-    """
-    Load information about each of our users into memory.  Identify each user
-    with the corresponding row number in the spreadsheet.  We use email as the
-    main key because it's a required field and it's usually useful later on.
-    """
-    users = {}  # Key is user row number, value is a dictionary with user
-    # information
-    emails = {}  # Key is email, value is user ID
-
-    columns = {
-        k: v for k, v in columns.items() if k in load_columns + ["email"]
-    }
-
-    row_number = 2  # Skip the header row (see parse_worksheet_columns)
-    value = worksheet.cell(row=row_number, column=columns["email"]).value
-    match_columns = set()
-    while value:
-        users[row_number] = {
-            "email": value,
-            "id": row_number,
-        }
-        emails[value] = row_number
-        user = users[row_number]
-        for column in columns:
-            if columns[column] is None:
-                # Transmit the None so future calls can dereference the
-                # column easily, without needing to first check if the key
-                # exists.
-                user[column] = None
-            elif column == "all_matches" or is_match_column_header(column):
-                # Match columns are special and contain a list of all of columns.
-                if column not in user:
-                    user[column] = []
-                    match_columns.add(column)
-                for match_col in columns[column]:
-                    value = worksheet.cell(
-                        row=row_number, column=match_col
-                    ).value
-                    if value is not None:
-                        user[column].append(value)
-            else:
-                user[column] = worksheet.cell(
-                    row=row_number, column=columns[column]
-                ).value
-
-        row_number += 1
-        value = worksheet.cell(row=row_number, column=columns["email"]).value
-
-    # Convert the emails from the match columns into IDs.
-    for id, user in users.items():
-        for match_column in match_columns:
-            if match_column in user:
-                match_ids = []
-                for match_email in user[match_column]:
-                    match_ids.append(emails[match_email])
-                user[match_column] = match_ids
-
-    return users
-
-
-def make_match_column_header(lunch_date):
-    return f"match_{lunch_date.strftime(r'%Y%m%d')}"
-
-
-def is_match_column_header(header):
-    return re.match(r"^match_\d{8}$", header) is not None
-
-
-def match_users(users):
-    """
-    Return a list of tuples representing each of the matches.
-    """
-    scores = {}
-    users_by_score = defaultdict(set)
-
-    def score_match(user_a, user_b):
-        # Avoid matching people that have already been matched.
-        if user_a["id"] in user_b["all_matches"]:
-            user_b["id"] in user_a["all_matches"]
-            return -1
-
-        if user_a["new_to_cluster"] or user_b["new_to_cluster"]:
-            return 2 if user_a["cluster"] == user_b["cluster"] else 1
-
-        # For everyone else, prefer matching with someone outside of their
-        # cluster.
-        return 1 if user_a["cluster"] != user_b["cluster"] else 0
-
-    def remove_all_matches_for_user(user_id):
-        for other_user_id in users:
-            if user_id == other_user_id:
-                continue
-            pair = (
-                min(user_id, other_user_id),
-                max(user_id, other_user_id),
-            )
-            if pair in scores:
-                users_by_score[scores[pair]].remove(pair)
-                del scores[pair]
-
-    # Make a 2D map of two user IDs to their "score", which indicates how likely
-    # we should be to pair these two up.
-    for first_user_id in users:
-        for second_user_id in users:
-            if first_user_id >= second_user_id:
-                continue
-
-            score = score_match(users[first_user_id], users[second_user_id])
-            pair = (first_user_id, second_user_id)
-            scores[pair] = score
-            users_by_score[score].add(pair)
-
-    matches = []
-    sorted_scores = sorted(users_by_score.keys(), reverse=True)
-    for score in sorted_scores:
-        # Randomly match one pair at a time until we run out of pairs.
-        while users_by_score[score]:
-            match = random.choice(list(users_by_score[score]))
-            matches.append(match)
-
-            # Clear this match from everywhere
-            remove_all_matches_for_user(match[0])
-            remove_all_matches_for_user(match[1])
-
-    return matches
-
-
-def update_worksheet_with_matches(
-    worksheet, users, columns, matches, lunch_date
-):
-    """
-    Update the XLSX workbook with each person's match.  The matches are a list
-    of tuples, with each user identified by their row number in the spreadsheet.
-    """
-
-    # First make the new match header, at the end of the sheet so as not to
-    # invalidate any of our other indices.
-    match_column = columns["first_empty"]
-    worksheet.cell(row=1, column=match_column).value = make_match_column_header(
-        lunch_date
-    )
-
-    # Now go through each match and write it into the spreadsheet.
-    for match in matches:
-        emails = (users[match[0]]["email"], users[match[1]]["email"])
-        worksheet.cell(row=match[0], column=match_column).value = emails[1]
-        worksheet.cell(row=match[1], column=match_column).value = emails[0]
-
-
-def send_match_emails(users, lunch_date, template_path, dry_run=False):
-    """
-    Send emails to each person about their match.
-    """
-    # Make a dictionary mapping the users' email address back to their row
-    # numbers.  We'll use this for getting the match information.
-    users_by_id = {v["id"]: v for v in users.values()}
-    match_column_header = make_match_column_header(lunch_date)
-
-    # Send emails serially, because I doubt that Powershell and Outlook support
-    # sending emails in parallel.
-    pretty_date = lunch_date.strftime("%A %B %d, %Y")
-    send_failures = []  # Tracks the send failures that we encountered.
-    for user in users.values():
-        if user[match_column_header] and user["frequency"] > 0:
-            matches = [
-                users_by_id[match_id] for match_id in user[match_column_header]
-            ]
-
-            def join_emails(matches):
-                # https://www.rfc-editor.org/rfc/rfc6068#section-2 says that commas
-                # are valid delimiters.  This may not be implemented in all email
-                # clients, though.
-                return ",".join(m["email"] for m in matches)
-
-            def join_names(matches, key):
-                if len(matches) <= 2:
-                    return " and ".join(m[key] for m in matches)
-                else:
-                    return (
-                        ", ".join(m[key] for m in matches[:-1])
-                        + f", and {matches[-1][key]}"
-                    )
-
-            def join_genders(matches):
-                return matches[0]["gender"] if len(matches) == 1 else "plural"
-
-            args = [
-                "powershell.exe",
-                ".\\lunch-roulette-email.ps1",
-                "-email",
-                f"'{user['email']}'",
-                "-template",
-                f"'{template_path}'",
-                "-replacements",
-                "@{"
-                f"'VarFriendlyName'='{user['friendly_name']}'"
-                f"; 'VarLunchDate'='{pretty_date}'"
-                f"; 'VarOtherEmail'='{join_emails(matches)}'"
-                f"; 'VarOtherFriendlyName'='{join_names(matches, 'friendly_name')}'"
-                f"; 'VarOtherFullName'='{join_names(matches, 'full_name')}'"
-                f"; 'VarOtherGender'='{join_genders(matches)}'"
-                "}",
-            ]
-            logger.info(f"Sending email to {user['email']}...")
-
-            if dry_run:
-                print(" ".join(args))
-            else:
-                completed_process = subprocess.run(args)
-                if completed_process.returncode != 0:
-                    logger.error(f"Failed to send email to {user['email']}")
-                    send_failures.append(user)
-
-    if send_failures:
-        logger.error(
-            "Failed to send emails to the following users:"
-            + "\n  ".join([u["email"] for u in send_failures])
-        )
-
-
-def send_announcement_emails(users, template_path, dry_run=False):
-    # Send emails serially, because I doubt that Powershell and Outlook support
-    # sending emails in parallel.
-    send_failures = []  # Tracks the send failures that we encountered.
-    for user in users.values():
-        if user["frequency"] > 0:
-            args = [
-                "powershell.exe",
-                ".\\lunch-roulette-email.ps1",
-                "-email",
-                f"'{user['email']}'",
-                "-template",
-                f"'{template_path}'",
-                "-replacements",
-                "@{" f"'VarFriendlyName'='{user['friendly_name']}'" "}",
-            ]
-            logger.info(f"Sending email to {user['email']}...")
-
-            if dry_run:
-                print(" ".join(args))
-            else:
-                completed_process = subprocess.run(args)
-                if completed_process.returncode != 0:
-                    logger.error(f"Failed to send email to {user['email']}")
-                    send_failures.append(user)
-
-    if send_failures:
-        logger.error(
-            "Failed to send emails to the following users:"
-            + "\n  ".join([u["email"] for u in send_failures])
-        )
-
-
-if __name__ == "__main__":
-    main()
+"""
+This is the main entry point for the lunch roulette script.
+"""
+
+import argparse
+from collections import defaultdict
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import openpyxl
+from contextlib import closing
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Matches the headers of the match columns, which look like match_YYYYMMDD.
+# Compiled once here because is_match_column_header runs for every header on
+# every invocation.
+_MATCH_COLUMN_RE = re.compile(r"^match_\d{8}$")
+
+# The frequency values we know how to handle (see load_users).
+_VALID_FREQUENCIES = frozenset((None, 0, 1, 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Read and write to the supplied XLSX file to match people"
+        " for lunch roulette"
+    )
+    parser.add_argument(
+        "--xlsx",
+        required=True,
+        help="The path to the XLSX file that stores lunch roulette information",
+    )
+    parser.add_argument(
+        "--out",
+        help="If supplied, the input XLSX file will not be overwritten for"
+        " changes, and this file will be written instead.  See --roulette for"
+        " what the rewritten file preserves.",
+    )
+    parser.add_argument(
+        "--lunch-date",
+        type=lambda x: datetime.strptime(x, r"%Y%m%d").date(),
+        help="The date of the lunch we're rouletting for, in YYYYMMDD format",
+    )
+    action_group = parser.add_mutually_exclusive_group(required=True)
+    action_group.add_argument(
+        "--roulette",
+        action="store_true",
+        help="Match people for the lunch date and add a column to the XLSX file"
+        " named like match_YYYYMMDD with the results, for review.  The"
+        " rewritten workbook (the input file itself unless --out is given)"
+        " keeps every sheet's values, but formulas are replaced with their"
+        " data and cell styling is not preserved.",
+    )
+    action_group.add_argument(
+        "--send-matches",
+        action="store_true",
+        help="If specified, emails will be sent for the given lunch date.  This"
+        " assumes that the XLSX file has a column named like match_YYYYMMDD for"
+        " the given lunch date.  The intention is for the XLSX file to be"
+        " filled in and reviewed before sending emails.",
+    )
+    action_group.add_argument(
+        "--send-announcement",
+        action="store_true",
+        help="Send an announcement email to all users that are subscribed to"
+        " lunch roulette.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="If specified, we'll print the commands that we would execute"
+        " without actually executing them.  So emails will not be sent, for"
+        " example.",
+    )
+    parser.add_argument(
+        "--template",
+        help="Path to the Outlook template to use with"
+        " lunch-roulette-email.ps1.  This argument is required if --send-emails"
+        " or --dry-run-send-emails is specified.",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="If specified, the log level will be DEBUG instead of INFO",
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stdout, level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        if args.roulette:
+            assert (
+                not args.dry_run
+            ), "--dry-run is not supported for --roulette"
+            assert (
+                args.lunch_date
+            ), "--lunch-date argument is required for --roulette"
+            out_filename = args.xlsx
+            if args.out:
+                out_filename = args.out
+            do_roulette(args.xlsx, args.lunch_date, out_filename)
+        elif args.send_matches:
+            assert (
+                args.lunch_date
+            ), "--lunch-date argument is required for sending matches"
+            assert (
+                args.template
+            ), "--template argument is required when sending emails"
+            send_matches(
+                args.xlsx,
+                args.lunch_date,
+                args.template,
+                dry_run=args.dry_run,
+            )
+        elif args.send_announcement:
+            assert (
+                args.template
+            ), "--template argument is required when sending emails"
+            send_announcement(
+                args.xlsx,
+                args.template,
+                dry_run=args.dry_run,
+            )
+    except PermissionError:
+        logger.error(
+            "Permission error!  Make sure that the XLSX file is not already"
+            " open in Excel."
+        )
+        raise
+
+
+def do_roulette(xlsx_filename, lunch_date, out_filename):
+    """
+    Do the lunch roulette.
+    """
+    columns, users = load_users_from_workbook(
+        xlsx_filename,
+        ["email", "frequency", "cluster", "new_to_cluster", "all_matches"],
+        # Only roulette the users that are subscribed.
+        filter_frequency=True,
+    )
+
+    # Match with no workbook open at all.  Everything the matcher needs is in
+    # the users dict, so there's no reason to hold the file (and whatever
+    # openpyxl has cached for it) while we do the compute-heavy part.
+    matches = match_users(users)
+    logger.debug(f"Matches: {matches}")
+
+    write_workbook_with_matches(
+        xlsx_filename, out_filename, users, columns, matches, lunch_date
+    )
+    logger.info(
+        f"Saved lunch roulette for {lunch_date.strftime('%Y-%m-%d')} to"
+        f" {out_filename}"
+    )
+
+
+def send_matches(xlsx_filename, lunch_date, template_path, dry_run=False):
+    """
+    Send the lunch roulette match emails.
+    """
+    match_column_header = make_match_column_header(lunch_date)
+    columns, users = load_users_from_workbook(
+        xlsx_filename,
+        [
+            "email",
+            "friendly_name",
+            "full_name",
+            "gender",
+            "frequency",
+            "all_matches",
+            match_column_header,
+        ],
+        # Don't filter out the unsubscribed users here: someone's match may
+        # point at a user that unsubscribed after the roulette, and that match
+        # must still resolve so the subscribed side gets their email.  Whether
+        # a user receives an email is decided in send_match_emails.
+    )
+
+    if match_column_header not in columns:
+        raise Exception(
+            f"XLSX file doesn't contain {match_column_header} column"
+        )
+
+    send_match_emails(users, lunch_date, template_path, dry_run=dry_run)
+
+
+def send_announcement(xlsx_filename, template_path, dry_run=False):
+    """
+    Send an announcement to everybody, not only those with matches on a
+    particular day.
+    """
+    columns, users = load_users_from_workbook(
+        xlsx_filename,
+        [
+            "email",
+            "friendly_name",
+            "frequency",
+        ],
+        # Only email the users that are subscribed.
+        filter_frequency=True,
+    )
+
+    send_announcement_emails(users, template_path, dry_run=dry_run)
+
+
+def load_users_from_workbook(
+    xlsx_filename, load_columns, filter_frequency=False
+):
+    """
+    Open the workbook and load its users with a single streaming pass over the
+    active worksheet.  Returns a (columns, users) tuple; see
+    parse_worksheet_columns and load_users for what each contains.
+    """
+    with closing(
+        # Use data_only so that we use the values as of the last time Excel
+        # opened the spreadsheet, instead of the raw formulas.  We can't
+        # compute the values of formulas in this script; that's too
+        # complicated.
+        #
+        # Nothing here writes the workbook, so open it read_only too.  That
+        # streams the sheet instead of building the full cell-object model,
+        # which is much faster and keeps memory flat on large rosters.
+        openpyxl.load_workbook(xlsx_filename, data_only=True, read_only=True)
+    ) as workbook:
+        logger.debug(f"Opened XLSX file {xlsx_filename}")
+
+        # Assume that the active worksheet is the only interesting one.  This
+        # script wasn't written to account for multiple worksheets.  Using one
+        # iterator for the header row and the data rows means the sheet XML is
+        # only streamed through once.
+        rows = workbook.active.iter_rows(values_only=True)
+
+        # An empty worksheet yields no rows at all; hand an empty header row
+        # to the parser so it reports the missing required columns instead of
+        # us dying with a bare StopIteration here.
+        columns = parse_worksheet_columns(next(rows, ()))
+        logger.debug(f"Parsed columns from the workbook: {columns}")
+
+        users = load_users(
+            rows, columns, load_columns, filter_frequency=filter_frequency
+        )
+        logger.debug(f"Parsed {len(users)} users: {users}")
+
+    return columns, users
+
+
+def parse_worksheet_columns(header_row):
+    """
+    Parse the provided header row, a tuple of the worksheet's first row of
+    values, to identify the columns that we care about.
+    """
+    columns = {
+        "email": None,
+        "frequency": None,
+        "friendly_name": None,
+        "full_name": None,
+        "gender": None,
+        "cluster": None,
+        "year": None,
+        "new_to_cluster": None,
+        "all_matches": [],  # This is a special storing all of the match columns
+        "first_empty": None,  # This is a placeholder
+    }
+    required_columns = [
+        "email",
+        "friendly_name",
+        "full_name",
+        "gender",
+        "cluster",
+        "year",
+    ]
+
+    # Iterate through the header row, assuming that it contains all of the
+    # column headers.  Track the last non-empty header we see, so first_empty
+    # is well defined whether the row ends with values, empty cells, or no
+    # cells at all.
+    last_nonempty = 0
+    for column_number, value in enumerate(header_row, start=1):
+        if not value:
+            break
+        last_nonempty = column_number
+        logger.debug(f"Column #{column_number} header: {value}")
+
+        # Save all of the match columns.
+        if is_match_column_header(value):
+            # Match columns can be duplicated, to signify that some people got more than one match.
+            if value not in columns:
+                columns[value] = []
+            columns[value].append(column_number)
+            columns["all_matches"].append(column_number)
+        elif value in columns and value not in ["first_empty"]:
+            columns[value] = column_number
+
+    assert columns["first_empty"] is None
+    columns["first_empty"] = last_nonempty + 1
+
+    for required_column in required_columns:
+        if columns[required_column] is None:
+            raise Exception(
+                f"Worksheet missing required column {required_column}"
+            )
+
+    # Remove all None columns from the result.  This simplifies some of the
+    # usage elsewhere.  all_matches survives because it's a list, even when
+    # it's empty.
+    return {k: v for k, v in columns.items() if v is not None}
+
+
+def load_users(rows_iter, columns, load_columns, filter_frequency=False):
+    """
+    Load information about each of our users into memory.  Identify each user
+    with the corresponding row number in the spreadsheet.  We use email as the
+    main key because it's a required field and it's usually useful later on.
+
+    The rows_iter argument is an iterator of row value tuples starting at the
+    first data row, like worksheet.iter_rows(min_row=2, values_only=True).
+    Iterating the rows once is much faster than random cell access, especially
+    on read_only workbooks where every cell() call re-parses the sheet XML.
+
+    If filter_frequency is set, users whose frequency is empty or 0 are
+    dropped during the same pass, and any other frequency outside of 1 and 2
+    raises ValueError.  A worksheet without a frequency column at all means
+    everyone is subscribed.  We don't really support frequency beyond that at the
+    moment; 2 is a placeholder for those students that may be willing to meet
+    more frequently.
+    """
+    users = {}  # Key is user row number, value is a dictionary with user
+    # information
+    emails = {}  # Key is email, value is user ID
+
+    load_columns = frozenset(load_columns) | {"email"}
+    columns = {k: v for k, v in columns.items() if k in load_columns}
+    assert "email" in columns, "Worksheet columns are missing email"
+
+    # Precompute the 0-based tuple index for each column so the row loop below
+    # only does sequential tuple lookups.  Match columns map to a list of
+    # indices because they can be duplicated (see parse_worksheet_columns).
+    value_indices = {}
+    match_indices = {}
+    for column, column_number in columns.items():
+        if column == "all_matches" or is_match_column_header(column):
+            match_indices[column] = [c - 1 for c in column_number]
+        else:
+            value_indices[column] = column_number - 1
+    email_index = value_indices["email"]
+
+    # The frequency column is optional (see the README).  Without one there's
+    # nothing to filter on, so everyone counts as subscribed; quietly dropping
+    # the whole roster here would be much worse.
+    frequency_index = value_indices.get("frequency")
+    if frequency_index is None:
+        filter_frequency = False
+
+    for row_number, row in enumerate(rows_iter, start=2):
+        # Rows can come back shorter than the header row when their trailing
+        # cells are empty, so guard every index against the row length.
+        email = row[email_index] if email_index < len(row) else None
+        if not email:
+            break
+
+        # Record the email of every row, even ones we filter out below, so
+        # that match columns referencing an unsubscribed user still resolve
+        # instead of warning that they're missing.
+        emails[email] = row_number
+
+        if filter_frequency:
+            frequency = None
+            if frequency_index < len(row):
+                frequency = row[frequency_index]
+            if frequency not in _VALID_FREQUENCIES:
+                raise ValueError(
+                    f"{email} has unsupported frequency {frequency}"
+                )
+            if not frequency:
+                continue
+
+        user = {"email": email, "id": row_number}
+        users[row_number] = user
+        for column, index in value_indices.items():
+            user[column] = row[index] if index < len(row) else None
+        for column, indices in match_indices.items():
+            # Match columns are special and contain a list of all of their
+            # non-empty values.
+            user[column] = [
+                row[i] for i in indices if i < len(row) and row[i] is not None
+            ]
+
+    # Convert the emails from the match columns into IDs.
+    for id, user in users.items():
+        for match_column in match_indices:
+            if not user[match_column]:
+                # Most match columns are empty for most users -- newer
+                # classmates have no history in the older columns -- so don't
+                # bother converting (or re-wrapping) nothing.
+                if match_column == "all_matches":
+                    user[match_column] = set()
+                continue
+            match_ids = []
+            for match_email in user[match_column]:
+                match_id = emails.get(match_email)
+                if match_id is None:
+                    # The match points at someone that's no longer in the
+                    # worksheet, e.g. a classmate that was removed after the
+                    # matches were made.  Warn and drop the reference rather
+                    # than crashing partway through whatever the caller is
+                    # doing with the users.
+                    logger.warning(
+                        f"{user['email']} has a match {match_email} in"
+                        f" {match_column} that isn't in the worksheet;"
+                        " ignoring it"
+                    )
+                    continue
+                match_ids.append(match_id)
+            if match_column == "all_matches":
+                # The matcher probes all_matches with `in` once per candidate
+                # partner, so store it as a set.
+                user[match_column] = set(match_ids)
+            else:
+                # Keep the dated match columns as lists, so that emails list
+                # multiple matches in the sheet's column order.
+                user[match_column] = match_ids
+
+    return users
+
+
+def make_match_column_header(lunch_date):
+    return f"match_{lunch_date.strftime(r'%Y%m%d')}"
+
+
+def is_match_column_header(header):
+    # The prefix check short-circuits most non-match headers without touching
+    # the regex engine at all.
+    return (
+        isinstance(header, str)
+        and header.startswith("match_")
+        and _MATCH_COLUMN_RE.match(header) is not None
+    )
+
+
+def match_users(users):
+    """
+    Return a list of tuples representing each of the matches.
+
+    Users are paired greedily from the most preferred kind of pair to the
+    least: anyone new to their cluster is matched within their cluster first,
+    then the remaining users are matched across clusters, then within their
+    cluster.  Previously matched pairs are avoided until no fresh partner is
+    left anywhere.  This mirrors the old all-pairs scoring (2 for a new user
+    in their cluster, 1 for any cross-cluster pair, 0 for a repeat-free
+    same-cluster pair, -1 for a repeat) but runs in one pass over the users
+    instead of enumerating every pair.
+    """
+
+    def make_pair(user_a_id, user_b_id):
+        # Keep the smaller ID first, so pairs have a canonical form.
+        if user_a_id < user_b_id:
+            return (user_a_id, user_b_id)
+        return (user_b_id, user_a_id)
+
+    def pop_partner(user_id, candidates):
+        """
+        Pop and return a partner for the user from the candidates list,
+        skipping anyone this user has already been matched with.  Returns None
+        if every candidate is a repeat, so the caller can fall through to a
+        less preferred pool.
+        """
+        previous_matches = all_matches_by_id[user_id]
+        for index in range(len(candidates) - 1, -1, -1):
+            if candidates[index] not in previous_matches:
+                return candidates.pop(index)
+        return None
+
+    # Bucket the users by cluster, keeping the new-to-cluster users separate
+    # so we can prioritize them.  Shuffling each bucket up front is what makes
+    # the greedy pairing below random.  The two flat maps pull out the only
+    # fields the matcher reads, so the loops below do a single lookup per
+    # access instead of going through the nested user dicts.
+    cluster_by_id = {}
+    all_matches_by_id = {}
+    new_by_cluster = defaultdict(list)
+    old_by_cluster = defaultdict(list)
+    for user in users.values():
+        user_id = user["id"]
+        cluster = user["cluster"]
+        cluster_by_id[user_id] = cluster
+        all_matches_by_id[user_id] = user["all_matches"]
+        if user.get("new_to_cluster"):
+            new_by_cluster[cluster].append(user_id)
+        else:
+            old_by_cluster[cluster].append(user_id)
+    for group in (new_by_cluster, old_by_cluster):
+        for user_ids in group.values():
+            random.shuffle(user_ids)
+
+    matches = []
+
+    # Phase 1: match each new-to-cluster user within their cluster, preferring
+    # other new users so that two new people aren't both "spent" on veterans.
+    for cluster, new_user_ids in new_by_cluster.items():
+        unpaired = []
+        while new_user_ids:
+            user_id = new_user_ids.pop()
+            partner_id = pop_partner(user_id, new_user_ids)
+            if partner_id is None:
+                partner_id = pop_partner(user_id, old_by_cluster[cluster])
+            if partner_id is None:
+                unpaired.append(user_id)
+            else:
+                matches.append(make_pair(user_id, partner_id))
+        new_by_cluster[cluster] = unpaired
+
+    # Phase 2: everyone left prefers a cross-cluster match.  Pop from the
+    # largest cluster and look for a partner in the others, largest first,
+    # which maximizes the number of cross-cluster pairs we can make.
+    pool_by_cluster = defaultdict(list)
+    for group in (new_by_cluster, old_by_cluster):
+        for cluster, user_ids in group.items():
+            pool_by_cluster[cluster].extend(user_ids)
+
+    deferred_by_cluster = defaultdict(list)
+    while True:
+        nonempty = [c for c, ids in pool_by_cluster.items() if ids]
+        if len(nonempty) < 2:
+            break
+        nonempty.sort(key=lambda c: len(pool_by_cluster[c]), reverse=True)
+        user_id = pool_by_cluster[nonempty[0]].pop()
+        partner_id = None
+        for cluster in nonempty[1:]:
+            partner_id = pop_partner(user_id, pool_by_cluster[cluster])
+            if partner_id is not None:
+                break
+        if partner_id is None:
+            user_cluster = cluster_by_id[user_id]
+            deferred_by_cluster[user_cluster].append(user_id)
+        else:
+            matches.append(make_pair(user_id, partner_id))
+
+    # Phase 3: match the rest within their cluster, still avoiding repeats.
+    leftovers = []
+    for cluster, user_ids in deferred_by_cluster.items():
+        pool_by_cluster[cluster].extend(user_ids)
+    for user_ids in pool_by_cluster.values():
+        while user_ids:
+            user_id = user_ids.pop()
+            partner_id = pop_partner(user_id, user_ids)
+            if partner_id is None:
+                leftovers.append(user_id)
+            else:
+                matches.append(make_pair(user_id, partner_id))
+
+    # Phase 4: anyone still unmatched can only repeat a previous match, which
+    # beats leaving them out entirely.
+    random.shuffle(leftovers)
+    while len(leftovers) >= 2:
+        matches.append(make_pair(leftovers.pop(), leftovers.pop()))
+
+    return matches
+
+
+def write_workbook_with_matches(
+    xlsx_filename, out_filename, users, columns, matches, lunch_date
+):
+    """
+    Copy the workbook to out_filename with a new column containing each
+    person's match.  The matches are a list of tuples, with each user
+    identified by their row number in the spreadsheet.
+
+    Instead of loading the whole cell-object model just to add one column and
+    save it back out, stream the original sheets row by row into a write-only
+    workbook.  Both sides of the copy then run in constant memory.  Every
+    worksheet is copied, with the match column added only on the active one,
+    but like data_only itself this drops formulas (and any cell styling) from
+    the output.  That matters most when out_filename is the input file.
+    """
+    # The new match column goes at the end of the sheet, so as not to
+    # invalidate any of our other indices.
+    match_column = columns["first_empty"]
+
+    # Map each matched user's row to the email of their match.
+    match_emails_by_row = {}
+    for match in matches:
+        match_emails_by_row[match[0]] = users[match[1]]["email"]
+        match_emails_by_row[match[1]] = users[match[0]]["email"]
+
+    workbook_out = openpyxl.Workbook(write_only=True)
+    with closing(
+        openpyxl.load_workbook(xlsx_filename, data_only=True, read_only=True)
+    ) as workbook:
+        for worksheet in workbook.worksheets:
+            worksheet_out = workbook_out.create_sheet(title=worksheet.title)
+
+            # Copy every worksheet, not only the active one, so the output
+            # (which is often the input file itself) doesn't silently lose
+            # sheets.  The users live on the active sheet, so the others are
+            # just copied value for value.
+            if worksheet is not workbook.active:
+                for row in worksheet.iter_rows(values_only=True):
+                    worksheet_out.append(row)
+                continue
+            workbook_out.active = worksheet_out
+
+            for row_number, row in enumerate(
+                worksheet.iter_rows(values_only=True), start=1
+            ):
+                # Rows can come back shorter than the header row when their
+                # trailing cells are empty, so pad them out to the match
+                # column.
+                new_row = list(row)
+                if len(new_row) < match_column:
+                    new_row.extend([None] * (match_column - len(new_row)))
+                if row_number == 1:
+                    new_row[match_column - 1] = make_match_column_header(
+                        lunch_date
+                    )
+                else:
+                    new_row[match_column - 1] = match_emails_by_row.get(
+                        row_number
+                    )
+                worksheet_out.append(new_row)
+    workbook_out.save(out_filename)
+
+
+def join_emails(matches):
+    # https://www.rfc-editor.org/rfc/rfc6068#section-2 says that commas
+    # are valid delimiters.  This may not be implemented in all email
+    # clients, though.
+    return ",".join(m["email"] for m in matches)
+
+
+def join_names(matches, key):
+    # Pull the names out once; the long form below would otherwise slice the
+    # matches list and fetch the last name a second time.
+    names = [m[key] for m in matches]
+    if len(names) <= 2:
+        return " and ".join(names)
+    else:
+        return ", ".join(names[:-1]) + f", and {names[-1]}"
+
+
+def join_genders(matches):
+    return matches[0]["gender"] if len(matches) == 1 else "plural"
+
+
+def send_match_emails(users, lunch_date, template_path, dry_run=False):
+    """
+    Send emails to each person about their match.
+    """
+    match_column_header = make_match_column_header(lunch_date)
+
+    # Build the replacements for every email first, then send the whole batch
+    # with one PowerShell invocation below.
+    pretty_date = lunch_date.strftime("%A %B %d, %Y")
+    email_batch = []  # One entry per email, for send_email_batch.
+    for user in users.values():
+        # Users only have a frequency key when the worksheet has a frequency
+        # column; without one, everyone is subscribed (see load_users).
+        if user[match_column_header] and user.get("frequency", 1):
+            # The users dict is keyed by row number, which is exactly what the
+            # match IDs are.
+            matches = [
+                users[match_id] for match_id in user[match_column_header]
+            ]
+
+            email_batch.append(
+                {
+                    "email": user["email"],
+                    "replacements": {
+                        "VarFriendlyName": user["friendly_name"],
+                        "VarLunchDate": pretty_date,
+                        "VarOtherEmail": join_emails(matches),
+                        "VarOtherFriendlyName": join_names(
+                            matches, "friendly_name"
+                        ),
+                        "VarOtherFullName": join_names(matches, "full_name"),
+                        "VarOtherGender": join_genders(matches),
+                    },
+                }
+            )
+
+    send_email_batch(email_batch, template_path, dry_run=dry_run)
+
+
+def send_email_batch(email_batch, template_path, dry_run=False):
+    """
+    Send a batch of emails with a single lunch-roulette-email.ps1 invocation.
+    PowerShell takes hundreds of milliseconds to start, so starting one
+    process for the whole batch instead of one per email amortizes that cost,
+    and the script reuses its Outlook connection between sends.
+
+    Each entry in the batch is a dictionary with an "email" address and a
+    "replacements" dictionary, passed to the script as a JSON file.
+    """
+    if not email_batch:
+        logger.info("No emails to send")
+        return
+
+    for entry in email_batch:
+        logger.info(f"Sending email to {entry['email']}...")
+
+    batch_file = tempfile.NamedTemporaryFile(
+        mode="w", suffix=".json", delete=False
+    )
+    try:
+        json.dump(email_batch, batch_file)
+        batch_file.close()
+
+        args = [
+            "powershell.exe",
+            ".\\lunch-roulette-email.ps1",
+            "-template",
+            template_path,
+            "-batchFile",
+            batch_file.name,
+        ]
+
+        if dry_run:
+            print(" ".join(args))
+            print(json.dumps(email_batch, indent=2))
+        else:
+            completed_process = subprocess.run(args)
+            if completed_process.returncode != 0:
+                # The script logs each send failure as it happens, and its
+                # exit code is the number of failed sends.
+                logger.error(
+                    "lunch-roulette-email.ps1 exited with code"
+                    f" {completed_process.returncode}; see the output above"
+                    " for the affected addresses."
+                )
+    finally:
+        # Keep the batch file around on a dry run so that the printed command
+        # can actually be executed.
+        if not dry_run:
+            os.remove(batch_file.name)
+
+
+def send_announcement_emails(users, template_path, dry_run=False):
+    """
+    Send the announcement email to everyone that's subscribed.
+    """
+    email_batch = []  # One entry per email, for send_email_batch.
+    for user in users.values():
+        email_batch.append(
+            {
+                "email": user["email"],
+                "replacements": {
+                    "VarFriendlyName": user["friendly_name"],
+                },
+            }
+        )
+
+    send_email_batch(email_batch, template_path, dry_run=dry_run)
+
+
+if __name__ == "__main__":
+    main()